@@ -6,17 +6,267 @@
 # Date     : Tue, 15 Feb 20:09 +0100
 # ----------------------------------------------------------------------
 
+import os
 import sys
+import time
+import errno
+import signal
 import asyncio
-import uuid
-import aiofiles
-import bintrees
+import functools
+import concurrent.futures
+import socket
+import multiprocessing
+import numpy as np
+import uvloop
 
 ADDR = 'localhost'
 PORT = 4000
 MAX_CONNECTIONS = 5
 LOG_FILENAME = "numbers.log"
 REPORT_PERIODICITY = 10
+SHARDS = os.cpu_count()
+
+# Special sequence that shuts down the server.
+TERMINATE_SEQUENCE = b'terminate\n'
+
+# Masks and multipliers to validate and parse 8 ASCII digits packed in a 64-bit
+# little endian word at once (SWAR, SIMD within a register).
+SWAR_HIGH_NIBBLES = np.uint64(0xF0F0F0F0F0F0F0F0)
+SWAR_LOW_NIBBLES = np.uint64(0x0F0F0F0F0F0F0F0F)
+SWAR_DIGITS_HIGH_NIBBLES = np.uint64(0x3333333333333333)
+SWAR_PLUS_SIX = np.uint64(0x0606060606060606)
+SWAR_PAIRS_MASK = np.uint64(0x00FF00FF00FF00FF)
+SWAR_QUADS_MASK = np.uint64(0x0000FFFF0000FFFF)
+SWAR_PAIRS_MUL = np.uint64(10 * (1 << 8) + 1)
+SWAR_QUADS_MUL = np.uint64(100 * (1 << 16) + 1)
+SWAR_OCTETS_MUL = np.uint64(10000 * (1 << 32) + 1)
+
+# Size of the log file buffer. Data is written to disk in chunks of 1MiB.
+LOG_BUFFER_SIZE = 1 << 20
+
+# Max amount of buffers that can be written with a single writev() call.
+IOV_MAX = os.sysconf('SC_IOV_MAX')
+
+# Max amount of seconds the new numbers are kept in the log file buffer.
+LOG_FLUSH_PERIOD = 1
+
+# Max amount of seconds to wait for the shards to stop when shutting down.
+SHUTDOWN_TIMEOUT = 10
+
+
+def parse_chunk(buf, length):
+
+    """ Validating the chunk byte by byte in Python is way too slow. I view all
+    the complete number sequences of the chunk as a matrix of N rows by 10
+    columns and validate the whole matrix at once with NumPy, that runs the
+    operations in a vectorized C loop. The first 9 columns must be valid
+    digits acording to their ASCII values and the last column must be the
+    escape sequence \n (10 in ASCII).
+
+    The first 8 digits of every sequence are also viewed (without any copy)
+    as a 64-bit word, so all of them are validated with a few bitwise
+    operations instead of 8 comparisons. Each byte is a digit only if its
+    high nibble is 3 and still is 3 after adding 6.
+
+    The digits are converted to numbers at once too. The 8 digits packed in
+    every word are combined in pairs, then in groups of 4 and finally in a
+    group of 8 with 3 multiplications (the first digit is in the lowest
+    byte). Then the 9th digit is appended.
+
+    Every NumPy operation allocates a new array for its result, so the
+    intermediate results are computed in place to allocate only a few arrays
+    per chunk.
+
+    Returns the matrix of number sequences, their numbers and the index of
+    the first invalid sequence (the count of sequences if all are valid)."""
+    frames = np.frombuffer(buf, dtype=np.uint8, count=length).reshape(-1, 10)
+    words = np.ndarray((len(frames),), dtype='<u8', buffer=buf, strides=(10,))
+
+    # (words & high nibbles) | (((words + 6) & high nibbles) >> 4)
+    numbers = words & SWAR_LOW_NIBBLES
+    check = words + SWAR_PLUS_SIX
+    check &= SWAR_HIGH_NIBBLES
+    check >>= 4
+    check += words
+    check -= numbers
+    invalid = check != SWAR_DIGITS_HIGH_NIBBLES
+
+    # Values lower than 48 wrap around, so a single comparison is needed
+    ninth_digit = frames[:, 8] - 48
+    invalid |= ninth_digit > 9
+    invalid |= frames[:, 9] != 10
+
+    valid = int(np.argmax(invalid)) if invalid.any() else len(frames)
+
+    numbers *= SWAR_PAIRS_MUL
+    numbers >>= 8
+    numbers &= SWAR_PAIRS_MASK
+    numbers *= SWAR_QUADS_MUL
+    numbers >>= 16
+    numbers &= SWAR_QUADS_MASK
+    numbers *= SWAR_OCTETS_MUL
+    numbers >>= 32
+    numbers *= 10
+    numbers += ninth_digit
+
+    return frames, numbers, valid
+
+
+class NumbersShard:
+
+    def __init__(self, index, shards, receiver, senders, filename, counters):
+
+        self.index_ = index
+        self.shards_ = shards
+        self.receiver_ = receiver
+        self.senders_ = senders
+        self.filename_ = filename
+        self.counters_ = counters
+
+        """ Numbers have 9 digits, so there are only 10^9 possible numbers and
+        a shard only receives the numbers whose modulo the count of shards is
+        its index. Instead of sets of numbers, that would need tens of GB of
+        memory, there is a bitmap with one bit for every number of the shard
+        to know if a number has been seen, and another one to know if it has
+        been duplicated. Both take 250MB among all the shards."""
+        self.seen = None
+        self.dup = None
+        self.logfile = None
+        self.logfile_buffer = []
+        self.logfile_buffer_size = 0
+        self.last_flush = time.monotonic()
+        self.current_report = [0, 0, 0]
+        """ current_report[0] -> count of unique numbers received.
+            current_report[1] -> count of duplicate numbers.
+            current_report[2] -> count of total unique numbers received."""
+
+    def run(self):
+
+        # Ctrl+c interruptions are handled by the server process
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        """ The shard process inherits the sending ends of the pipes created
+        by the server so far, including its own one. They must be closed, so
+        the pipe reaches EOF when the server process dies."""
+        for sender in self.senders_:
+            sender.close()
+
+        # Allocate the bitmaps in the shard process
+        size = (10 ** 9 // self.shards_) // 8 + 1
+        self.seen = np.zeros(size, dtype=np.uint8)
+        self.dup = np.zeros(size, dtype=np.uint8)
+
+        """ Open a file descriptor to append non duplicated numbers. All the
+        shards append to the same log file. Each write is appended atomically
+        at the end of the file and contains only complete number sequences, so
+        the numbers of different shards are not mixed in the same line. Only
+        if a write is partial (e.g. the disk is full), its remaining part is
+        appended by a later write and a line may be split."""
+        self.logfile = os.open(self.filename_, os.O_WRONLY | os.O_APPEND)
+
+        """ An empty message is sent by the server when shutting down. If the
+        server process dies without shutting down, the pipe reaches EOF (an
+        OSError is raised if it dies while sending a message). In all cases
+        the pending numbers are written and the shard stops. The buffered
+        numbers are also written when no message arrives for a while, so the
+        log file does not lag behind at low rates."""
+        while True:
+            try:
+                if not self.receiver_.poll(LOG_FLUSH_PERIOD):
+                    self.flush_log()
+                    continue
+                data = self.receiver_.recv_bytes()
+            except (EOFError, OSError):
+                break
+            if not data:
+                break
+            self.consume_numbers(data)
+
+        self.flush_log()
+        os.close(self.logfile)
+
+    def write_log(self, data):
+
+        """ A buffered file copies all the data into its own buffer before
+        writing it, and the kernel copies it again into the page cache. The
+        log file is never read by the server, so there is no need for the
+        first copy. The blocks of new numbers are kept as they are and written
+        at once with vectored I/O (scatter-gather) when they reach 1MiB or
+        have been waiting for LOG_FLUSH_PERIOD seconds, so syscalls are still
+        amortized."""
+        self.logfile_buffer.append(data)
+        self.logfile_buffer_size += len(data)
+        if (self.logfile_buffer_size >= LOG_BUFFER_SIZE
+                or len(self.logfile_buffer) >= IOV_MAX
+                or time.monotonic() - self.last_flush >= LOG_FLUSH_PERIOD):
+            self.flush_log()
+
+    def flush_log(self):
+
+        self.last_flush = time.monotonic()
+        if not self.logfile_buffer:
+            return
+
+        written = os.writev(self.logfile, self.logfile_buffer)
+
+        # Complete the write in case of a partial write
+        if written < self.logfile_buffer_size:
+            remaining = memoryview(b''.join(self.logfile_buffer))[written:]
+            while remaining:
+                remaining = remaining[os.write(self.logfile, remaining):]
+
+        self.logfile_buffer.clear()
+        self.logfile_buffer_size = 0
+
+    def consume_numbers(self, data):
+
+        """ Each message contains the numbers dispatched to this shard as
+        64-bit integers followed by their 10 bytes long number sequences."""
+        count = len(data) // 18
+        numbers = np.frombuffer(data, dtype=np.uint64, count=count)
+        frames = np.frombuffer(data, dtype=np.uint8,
+                               offset=count * 8).reshape(-1, 10)
+
+        """ All the numbers of the message are classified at once with NumPy,
+        there is no loop over every single number. Each distinct number of
+        the message is looked up once in the bitmaps, at the bit given by its
+        position among the numbers of the shard."""
+        bits, first_indexes, counts = np.unique(numbers // self.shards_,
+                                                return_index=True,
+                                                return_counts=True)
+        is_seen = ((self.seen[bits >> 3] >> (bits & 7)) & 1) != 0
+        is_dup = ((self.dup[bits >> 3] >> (bits & 7)) & 1) != 0
+
+        """ The numbers not seen before are new unique numbers. Any other
+        occurrence of a number in the message is a duplicate. The numbers
+        that were not marked as duplicated yet and are repeated now (either
+        they were seen before or they appear more than once in the message)
+        are not unique anymore."""
+        is_new = ~is_seen
+        new_dup = ~is_dup & (is_seen | (counts > 1))
+        new_count = int(np.count_nonzero(is_new))
+        new_dup_count = int(np.count_nonzero(new_dup))
+
+        np.bitwise_or.at(self.seen, bits[is_new] >> 3,
+                         np.left_shift(1, bits[is_new] & 7).astype(np.uint8))
+        np.bitwise_or.at(self.dup, bits[new_dup] >> 3,
+                         np.left_shift(1, bits[new_dup] & 7).astype(np.uint8))
+
+        self.current_report[0] += new_count
+        self.current_report[1] += count - new_count
+        self.current_report[2] += new_count - new_dup_count
+
+        """ The received number sequences are already valid log lines (ASCII
+        digits ending with \n), so the new ones are gathered with a single copy
+        in the order they were received and written at once. No decoding,
+        formatting or encoding of every single number is needed."""
+        if new_count:
+            new_indexes = np.sort(first_indexes[is_new])
+            self.write_log(frames[new_indexes].tobytes())
+
+        # Publish the counters of this shard to the server process
+        offset = self.index_ * 3
+        self.counters_[offset:offset+3] = self.current_report
 
 
 class NumbersServer:
@@ -26,36 +276,83 @@ class NumbersServer:
                  port=PORT,
                  max_connections=MAX_CONNECTIONS,
                  filename=LOG_FILENAME,
-                 periodicity=REPORT_PERIODICITY):
+                 periodicity=REPORT_PERIODICITY,
+                 shards=SHARDS):
 
         self.addr_ = addr
         self.port_ = port
         self.max_connections_ = max_connections
         self.filename_ = filename
         self.periodicity_ = periodicity
+        self.shards_ = shards
 
-        self.connections = {}
-        self.connections_count = 0
-        self.server = None
+        self.connections = set()
+        self.handlers = set()
+        self.servers = []
         self.timer = None
-        self.bst = bintrees.FastBinaryTree()
-        self.bst_lock = asyncio.Lock()
-        self.logfile = None
-        self.logfile_buffer = []
-        self.report_event = asyncio.Event()
-        self.current_report = [0, 0, 0]
-        """ current_report[0] -> count of new unique numbers received.
-            current_report[1] -> count of new duplicate numbers.
-            current_report[2] -> count of total unique numbers received."""
+        self.processes = []
+        self.senders = []
+        self.dispatchers = []
+        self.counters = multiprocessing.Array('q', 3 * shards, lock=False)
+        """ counters[3*i] -> count of unique numbers received by shard i.
+            counters[3*i+1] -> count of duplicate numbers received by shard i.
+            counters[3*i+2] -> count of total unique numbers of shard i."""
+        self.last_report = [0, 0]
+        """ last_report[0] -> count of unique numbers at the last report.
+            last_report[1] -> count of duplicate numbers at the last report."""
 
     async def run(self):
 
-        # Open an async file descriptor to write non duplicated numbers
-        self.logfile = await aiofiles.open(self.filename_, "w")
-
-        # Create the server task to handle TCP connections at localhost:4000
-        self.server = await asyncio.start_server(self.connection_handler,
-                                                 self.addr_, self.port_)
+        # Create an empty log file. The shards append numbers to it.
+        open(self.filename_, "wb").close()
+
+        """ A single process can only use one CPU core, so the numbers are
+        processed by a pool of shard processes. Every number is always
+        dispatched to the same shard, so each shard manages its own disjoint
+        set of numbers and no synchronization among shards is needed."""
+        for index in range(self.shards_):
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            self.senders.append(sender)
+            shard = NumbersShard(index, self.shards_, receiver,
+                                 list(self.senders), self.filename_,
+                                 self.counters)
+            process = multiprocessing.Process(target=shard.run, daemon=True)
+            process.start()
+            receiver.close()
+            self.processes.append(process)
+
+            """ Sending data to a shard blocks when its pipe is full, so the
+            data is sent from a worker thread to not block the event loop.
+            Each shard has its own thread, so the data sent to a shard keeps
+            its order and a busy shard doesn't delay the other ones."""
+            self.dispatchers.append(
+                concurrent.futures.ThreadPoolExecutor(max_workers=1))
+
+        """ Create the server sockets to handle TCP connections at
+        localhost:4000. There is one socket for every address the host name
+        resolves to (e.g. both ::1 and 127.0.0.1 for localhost). The kernel
+        queues up to 4096 connections waiting to be accepted (instead of 100),
+        so bursts of reconnecting clients are not refused while the event loop
+        is busy processing data."""
+        addresses = socket.getaddrinfo(self.addr_, self.port_,
+                                       type=socket.SOCK_STREAM,
+                                       flags=socket.AI_PASSIVE)
+        try:
+            for family, kind, proto, _, address in dict.fromkeys(addresses):
+                server = socket.socket(family, kind, proto)
+                self.servers.append(server)
+                server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if family == socket.AF_INET6:
+                    # Don't take the IPv4 addresses of a dual-stack socket
+                    server.setsockopt(socket.IPPROTO_IPV6,
+                                      socket.IPV6_V6ONLY, 1)
+                server.bind(address)
+                server.listen(4096)
+                server.setblocking(False)
+        except OSError:
+            for server in self.servers:
+                server.close()
+            raise
 
         # Generate the first report to show the initial status
         await self.generate_report()
@@ -64,9 +361,33 @@ class NumbersServer:
         self.timer = asyncio.create_task(self.timer_runner(self.periodicity_,
                                                            self.generate_report))
 
-        # Keep the server running in the event loop
-        async with self.server:
-            await self.server.serve_forever()
+        # Keep the server accepting connections in the event loop
+        await asyncio.gather(*(self.accept_connections(server)
+                               for server in self.servers))
+
+    async def accept_connections(self, server):
+
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                sock, _ = await loop.sock_accept(server)
+            except OSError as ex:
+                """ Pending network errors of a new connection are reported
+                by accept(), they only affect that connection. When the
+                process is out of file descriptors or memory, wait a second
+                before accepting connections again."""
+                print("Error accepting a connection: %s" % ex,
+                      file=sys.stderr, flush=True)
+                if ex.errno in (errno.EMFILE, errno.ENFILE,
+                                errno.ENOBUFS, errno.ENOMEM):
+                    await asyncio.sleep(1)
+                continue
+
+            """ The event loop only keeps weak references to the tasks, so a
+            reference is kept until the connection handler finishes."""
+            handler = asyncio.create_task(self.connection_handler(sock))
+            self.handlers.add(handler)
+            handler.add_done_callback(self.handlers.discard)
 
     async def timer_runner(self, timeout, operation):
         while True:
@@ -75,197 +396,216 @@ class NumbersServer:
 
     async def generate_report(self):
 
-        self.report_event.clear()
-        print("Received %d unique numbers, %d duplicates. Unique total: %d"
-              % (self.current_report[0],
-                 self.current_report[1],
-                 self.current_report[2]),
-              file=sys.stdout,
-              flush=True)
-        self.current_report[0] = 0
-        self.current_report[1] = 0
-
-        # Process and flush buffered logs to disk
-        await self.logfile.write('\n'.join(self.logfile_buffer))
-
-        # Clean the buffer
-        self.logfile_buffer.clear()
-
-        self.report_event.set()
-
-    async def close_connection(self, connection_id):
-
-        connection_data = self.connections.get(connection_id, None)
-        if connection_data is not None:
-            connection_data['writer'].close()
-            del self.connections[connection_id]
-            self.connections_count -= 1
+        """ The shards only increase their counters, so the counts for the
+        current report are the difference with the counts at the last report.
+        This way the shards are never paused during the report generation."""
+        unique = sum(self.counters[0::3])
+        duplicates = sum(self.counters[1::3])
+        report = ("Received %d unique numbers, %d duplicates. Unique total: %d"
+                  % (unique - self.last_report[0],
+                     duplicates - self.last_report[1],
+                     sum(self.counters[2::3])))
+        self.last_report[0] = unique
+        self.last_report[1] = duplicates
+
+        """ Writing to the stdout blocks when it is a pipe and the reader is
+        slow. The snapshot of the counters has been already taken, so the
+        report is printed from a worker thread and the event loop keeps
+        serving the clients meanwhile."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, functools.partial(print, report,
+                                                           file=sys.stdout,
+                                                           flush=True))
+
+    async def close_connection(self, sock):
+
+        if sock in self.connections:
+            sock.close()
+            self.connections.discard(sock)
 
     def shutdown(self):
 
-        for connection_id in self.connections.keys():
-            self.connections[connection_id]['writer'].close()
+        for sock in self.connections:
+            sock.close()
         self.connections.clear()
 
         self.timer.cancel()
-        self.server.close()
-        self.logfile.close()
+        for server in self.servers:
+            server.close()
+
+        # Wait for the shards to process the pending numbers and stop
+        for dispatcher, sender in zip(self.dispatchers, self.senders):
+            dispatcher.submit(sender.send_bytes, b'')
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for process in self.processes:
+            process.join(max(0, deadline - time.monotonic()))
+
+        """ A stalled shard would keep the server from exiting, so the shards
+        still running after the timeout are terminated (or killed if they are
+        stopped). Then the pipe of a terminated shard is broken, so a worker
+        thread blocked sending data to it fails and the pending data is
+        discarded."""
+        for process in self.processes:
+            if process.is_alive():
+                print("Shard %s did not stop, terminating it" % process.name,
+                      file=sys.stderr, flush=True)
+                process.terminate()
+                process.join(1)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        for dispatcher in self.dispatchers:
+            dispatcher.shutdown(wait=False, cancel_futures=True)
         loop = asyncio.get_event_loop()
         loop.stop()
 
-    async def consume_stream(self, reader_: asyncio.StreamReader) -> str:
+    async def consume_stream(self, sock: socket.socket) -> str:
+
+        loop = asyncio.get_running_loop()
 
-        remaining_buf = b''
+        """ Im assuming the application will receive massive amounts of data,
+        so use a proper buffer size should avoid lots of internal memory
+        allocation and overhead when dealing with the TCP stream. The buffer is
+        allocated once per connection and the data is received directly into
+        it, so no new bytes object is created for every chunk received. It has
+        room for 64KiB of data plus an incomplete number sequence. The buffer
+        is accessed through a single memoryview, so slicing it neither copies
+        data nor allocates a new buffer."""
+        buf = bytearray(65536 + 10)
+        view = memoryview(buf)
+        tail = 0
 
         while True:
 
-            """ Im assuming the application will receive massive amounts of
-            data, so use a proper buffer size should avoid lots of internal
-            memory allocation and overhead when dealing with the TCP stream."""
-            buf = await reader_.read(4096)
+            nbytes = await loop.sock_recv_into(sock, view[tail:])
 
-            if not buf:
+            if not nbytes:
                 # The peer has been disconnected
                 return "close"
 
-            if remaining_buf is not None:
-                buf = remaining_buf + buf
-
-            remaining_buf = None
+            size = tail + nbytes
 
             """ The application expects to receive sequences of numbers of fixed
-            size, so to parse each sequence I get individual slices of the
-            buffer by using an offset. I use the Unix escape sequence. So each
-            number sequence should contain one extra byte in the end for the \n
-            character. So, each number sequence MUST be 10 bytes long."""
-            for offset in range(0, len(buf), 10):
-                byte_array = buf[offset:offset+10]
-                length = len(byte_array)
-
-                """ Data transfered through TCP connections is unpredictable.
-                Received chunks of data may have different sizes. So, the last
-                number sequence received in a chunk can be incomplete. An
-                incomplete number sequence has a lenght < 10. So the remaining
-                number sequece in the current chunk must be concatenated at the
-                begining of the next chunk received."""
-                if length < 10:
-                    remaining_buf = buf[-length:]
-                    break
-
-                """ Validate that the escape sequence is valid.
-                Unix/Linux escape sequence is \n (LF). 10 in ASCII encoding."""
-                if byte_array[9] != 10:
-                    # Invalid escape sequence
-                    return "close"
-
-                """ Validate that the first 9 characters are valid numbers
-                acording to their ASCII values. Also check for the presence of
-                the 'terminate' sequence."""
-                for index in range(9):
-                    if byte_array[index] < 48 or byte_array[index] > 57:
-                        # Check if matches with the "terminate" sequence.
-                        if byte_array == b'terminate\n':
-                            return "terminate"
-                        return "close"
-
-                """ Convert the array of bytes to a string and remove the escape
-                sequence. The decode() function can throw potential
-                UnicodeDecodeError exceptions. As I previously validated all
-                the characters in the array, I decided to avoid using
-                try/except statements just for simplicity."""
-                number_str = byte_array.decode('utf8').strip()
-
-                """ Converts the data to a number. Using numbers as keys in a
-                BST is preferred over strings. Comparing numbers is way faster
-                than comparing strings, at least in this case."""
-                number = int(number_str)
-
-                """ As the BST structure can be read or updated by multiple
-                concurrent stream consumers. A lock is needed to avoid race
-                conditions and unexpected behaviours."""
-                await self.bst_lock.acquire()
-
-                """ An Event is sent each time the report generation starts. An
-                asyncio Event works like a lock activated asyncroniusly. That
-                ensures that all stream consumers dont't update the BST and the
-                current_report while the application is generating the report
-                and flushing buffered data to disk."""
-                if not self.report_event.is_set():
-                    await self.report_event.wait()
-
-                try:
-                    """ Check if the number is already present in the BST and
-                    also check if the number has been duplicated at least once
-                    in the past."""
-                    is_duplicated = self.bst.get_value(number)  # O(log(n))
-
-                    """ If no KeyError exception has been raised (number not
-                    found in the BST) then this is a duplicated number. Set
-                    this number as duplicated only if the number is not marked
-                    as duplicated yet, and decrease the counter of total unique
-                    numbers received."""
-                    if not is_duplicated:
-                        self.bst.insert(number, True)  # O(log(n))
-                        self.current_report[2] -= 1
-
-                    """ Increase the counter of duplicated numbers for the
-                    current report."""
-                    self.current_report[1] += 1
-
-                except KeyError as ex:
-                    """ Number not found in the BST. So this is a new unique
-                    number. Increase the counter of unique numbers received."""
-                    self.current_report[0] += 1
-
-                    # Insert the number to the BST (marked as not duplicated).
-                    self.bst.insert(number, False)  # O(log(n))
-
-                    """ Stores the new number in a memory buffer instead of
-                    writing directly to disk in the log file. Writing small
-                    chunks of data massivelly is extremelly ineficient. Writing
-                    a big buffer of data is way faster. Buffer will be flushed
-                    to disk during the report generation."""
-                    self.logfile_buffer.append(number_str)
-
-                    # Increase the counter of total unique numbers received.
-                    self.current_report[2] += 1
-
-                finally:
-                    # Unlock the shared resources
-                    self.bst_lock.release()
-
-    async def connection_handler(self, reader: asyncio.StreamReader,
-                                 writer: asyncio.StreamWriter):
-
-        if self.connections_count >= self.max_connections_:
-            writer.close()
+            size. I use the Unix escape sequence. So each number sequence
+            should contain one extra byte in the end for the \n character. So,
+            each number sequence MUST be 10 bytes long.
+
+            Data transfered through TCP connections is unpredictable. Received
+            chunks of data may have different sizes. So, the last number
+            sequence received in a chunk can be incomplete. The incomplete
+            number sequence is moved to the begining of the buffer and the next
+            chunk is received right after it."""
+            length = size - size % 10
+
+            """ A number sequence starting with a non digit character can
+            only be the 'terminate' sequence. If the chunk starts with it there
+            are no numbers to process, so the sequence is compared directly
+            (without copying it) and the whole chunk is not validated."""
+            if length and (buf[0] < 48 or buf[0] > 57):
+                if buf.startswith(TERMINATE_SEQUENCE):
+                    return "terminate"
+                return "close"
+
+            """ Validate and convert to numbers all the complete number
+            sequences of the chunk at once."""
+            frames, numbers, valid = parse_chunk(buf, length)
+
+            """ Only the number sequences preceding the first invalid one are
+            processed. The invalid sequence may be the 'terminate' sequence,
+            otherwise the connection must be closed."""
+            status = None
+            if valid < len(frames):
+                offset = valid * 10
+                if buf.startswith(TERMINATE_SEQUENCE, offset):
+                    status = "terminate"
+                else:
+                    status = "close"
+                frames = frames[:valid]
+                numbers = numbers[:valid]
+
+            """ Dispatch every number to its shard, given by the number modulo
+            the count of shards, along with its number sequence to be written
+            in the log file. The next chunk is not received until the numbers
+            have been sent to the shards. When a shard is busy, the TCP flow
+            control slows down only the clients sending numbers to it until the
+            shard catches up."""
+            shard_ids = (numbers % self.shards_).astype(np.intp)
+
+            """ The numbers are sorted by shard once (keeping the order they
+            were received in), so the numbers of every shard are a contiguous
+            slice and the chunk is not scanned again for every shard."""
+            order = np.argsort(shard_ids, kind='stable')
+            numbers = numbers[order]
+            frames = frames[order]
+            ends = np.cumsum(np.bincount(shard_ids, minlength=self.shards_))
+
+            start = 0
+            messages = []
+            for shard, end in enumerate(ends.tolist()):
+                if end > start:
+                    message = (numbers[start:end].tobytes()
+                               + frames[start:end].tobytes())
+                    messages.append(loop.run_in_executor(
+                        self.dispatchers[shard], self.senders[shard].send_bytes,
+                        message))
+                start = end
+            await asyncio.gather(*messages)
+
+            if status is not None:
+                return status
+
+            # Move the incomplete number sequence to the begining of the buffer
+            tail = size - length
+            view[:tail] = view[length:size]
+
+    async def connection_handler(self, sock: socket.socket):
+
+        if len(self.connections) >= self.max_connections_:
+            sock.close()
             return
 
-        self.connections_count += 1
-        connection_id = str(uuid.uuid1())
-        self.connections[connection_id] = {'reader': reader, 'writer': writer}
-        consume_task = asyncio.create_task(self.consume_stream(reader))
+        """ Clients send tiny number sequences of 10 bytes. Disable the Nagle's
+        algorithm for any data written to the client and, on Linux, ACK the
+        received data immediately instead of delaying the ACKs up to 40ms,
+        so clients waiting for ACKs are not stalled."""
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if hasattr(socket, 'TCP_QUICKACK'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+        self.connections.add(sock)
+        consume_task = asyncio.create_task(self.consume_stream(sock))
 
         try:
             await consume_task
             if consume_task.result() == "terminate":
                 self.shutdown()
             else:
-                await self.close_connection(connection_id)
-        except ConnectionResetError as ex:
-            # The connection has been closed due to an unexpected error.
-            await self.close_connection(connection_id)
+                await self.close_connection(sock)
+        except OSError as ex:
+            """ The connection has been closed due to an unexpected error, or
+            the numbers could not be sent to a shard (BrokenPipeError if the
+            shard process died)."""
+            await self.close_connection(sock)
 
 
 if __name__ == '__main__':
 
     try:
         server = NumbersServer()
-        loop = asyncio.get_event_loop()
+
+        """ The uvloop event loop is implemented on top of libuv in Cython, so
+        all the socket operations of the server run way faster than in the
+        default asyncio event loop."""
+        loop = uvloop.new_event_loop()
+        asyncio.set_event_loop(loop)
         loop.run_until_complete(server.run())
     except KeyboardInterrupt as ex:
         # Ctrl+c interruption
         server.shutdown()
+    except OSError as ex:
+        # The server sockets could not be created (e.g. address in use)
+        print("Error starting the server: %s" % ex, file=sys.stderr)
+        sys.exit(1)
     except:
         pass
 
@@ -6,6 +6,7 @@
 # Date     : Fri, 18 Feb 04:11 +0100
 # ----------------------------------------------------------------------
 
+import os
 import unittest
 import subprocess
 import signal
@@ -13,6 +14,8 @@ import sys
 import time
 import socket
 import random
+import tempfile
+import numpy as np
 from os.path import dirname, abspath, join
 from os import killpg, getpgid, setsid
 
@@ -21,6 +24,7 @@ server_path = dirname(abspath(join(__file__, "..")))
 sys.path.append(server_path)
 
 from server import ADDR, PORT, MAX_CONNECTIONS, LOG_FILENAME, REPORT_PERIODICITY
+from server import parse_chunk, NumbersShard
 
 class Integration(unittest.TestCase):
 
@@ -34,15 +38,17 @@ class Integration(unittest.TestCase):
 
     def start_server_process(self):
         server_script_path = join(server_path, 'server.py')
-        cmd = sys.executable + ' ' + server_script_path + ' > /dev/null 2> /dev/null &'
-        self.server_process = subprocess.Popen(cmd, shell=True, preexec_fn=setsid)
+        self.server_process = subprocess.Popen([sys.executable, server_script_path],
+                                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                               preexec_fn=setsid)
 
         # Wait 3 seconds to let the server launch and start listening for incoming connections.
         time.sleep(3)
 
     def kill_server_process(self):
         if self.server_process is not None:
-            killpg(getpgid(self.server_process.pid), signal.SIGTERM)
+            if self.server_process.poll() is None:
+                killpg(getpgid(self.server_process.pid), signal.SIGTERM)
             self.server_process.wait()
         self.server_process = None
 
@@ -143,6 +149,175 @@ class Integration(unittest.TestCase):
 
         sock.close()
 
+    def test_GivenNumbersRepeatedWithinAndAcrossConnections_WhenTheServerTerminates_ThenTheLogContainsEveryDistinctNumberOnce(self):
+        first_numbers = [random.randint(0, 29999) for i in range(20000)]
+        second_numbers = [random.randint(15000, 44999) for i in range(20000)]
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((ADDR, PORT))
+        sock.sendall(b''.join(b'%09d\n' % number for number in first_numbers))
+        sock.close()
+
+        # Let the server consume the numbers of the first connection before terminating it
+        time.sleep(1)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((ADDR, PORT))
+        sock.sendall(b''.join(b'%09d\n' % number for number in second_numbers) + b'terminate\n')
+        sock.close()
+
+        try:
+            self.server_process.wait(timeout=30)
+        except subprocess.TimeoutExpired as ex:
+            self.fail("The server did not exit after receiving the terminate sequence.")
+
+        with open(LOG_FILENAME) as logfile:
+            lines = logfile.read().split('\n')
+
+        # The log ends with a new line and every line is a number sequence logged once
+        self.assertEqual(lines.pop(), '')
+        self.assertEqual(len(lines), len(set(lines)))
+        self.assertEqual(set(lines), set('%09d' % number for number in first_numbers + second_numbers))
+
+
+class ParseChunk(unittest.TestCase):
+
+    VALID_FRAME = b'123456789\n'
+
+    def parse(self, frames):
+        buf = bytearray(b''.join(frames))
+        return parse_chunk(buf, len(buf))
+
+    def test_GivenValidNumberSequences_WhenParsingTheChunk_ThenAllTheNumbersAreParsed(self):
+        numbers = [0, 999999999, 123456789, 1, 100000000, 987654321]
+        numbers += [random.randint(0, 999999999) for i in range(1000)]
+        frames, parsed, valid = self.parse([b'%09d\n' % number for number in numbers])
+
+        self.assertEqual(valid, len(numbers))
+        self.assertEqual(parsed.tolist(), numbers)
+        self.assertEqual(frames.shape, (len(numbers), 10))
+
+    def test_GivenTheLowestAndHighestNumbers_WhenParsingTheChunk_ThenTheyAreParsed(self):
+        frames, parsed, valid = self.parse([b'000000000\n', b'999999999\n'])
+
+        self.assertEqual(valid, 2)
+        self.assertEqual(parsed.tolist(), [0, 999999999])
+
+    def test_GivenAnInvalidByteAtAnyPosition_WhenParsingTheChunk_ThenTheSequenceIsInvalid(self):
+        for position in range(10):
+            for value in range(256):
+                frame = bytearray(self.VALID_FRAME)
+                frame[position] = value
+                if position < 9:
+                    expected_valid = 48 <= value <= 57
+                else:
+                    expected_valid = value == 10
+
+                frames = [self.VALID_FRAME, self.VALID_FRAME, bytes(frame), self.VALID_FRAME]
+                _, _, valid = self.parse(frames)
+
+                self.assertEqual(valid, 4 if expected_valid else 2,
+                                 "byte %d at position %d" % (value, position))
+
+    def test_GivenBytesThatCarryToTheNextByteWhenAddingSix_WhenParsingTheChunk_ThenTheSequenceIsInvalid(self):
+        # Adding 6 to a byte >= 0xFA carries into the next byte of the word
+        for position in range(9):
+            for value in range(0xFA, 0x100):
+                for next_value in (0x2F, 0x30, 0x39):
+                    frame = bytearray(b'000000000\n')
+                    frame[position] = value
+                    frame[position + 1] = next_value if position < 8 else 10
+                    _, _, valid = self.parse([self.VALID_FRAME, bytes(frame)])
+
+                    self.assertEqual(valid, 1, "byte %d at position %d" % (value, position))
+
+    def test_GivenSeveralInvalidSequences_WhenParsingTheChunk_ThenTheFirstInvalidIndexIsReturned(self):
+        frames = [self.VALID_FRAME] * 7 + [b'terminate\n', self.VALID_FRAME, b'12345678\n\n']
+
+        _, _, valid = self.parse(frames)
+        self.assertEqual(valid, 7)
+
+        _, _, valid = self.parse([b'abcdefghi\n'] + frames)
+        self.assertEqual(valid, 0)
+
+        _, _, valid = self.parse([self.VALID_FRAME] * 7 + [b'12345678a\n'])
+        self.assertEqual(valid, 7)
+
+
+class ShardConsumeNumbers(unittest.TestCase):
+
+    SHARDS = 4
+    INDEX = 1
+
+    def setUp(self):
+        self.counters = [0] * (3 * self.SHARDS)
+        self.shard = NumbersShard(self.INDEX, self.SHARDS, None, [], None, self.counters)
+        size = (10 ** 9 // self.SHARDS) // 8 + 1
+        self.shard.seen = np.zeros(size, dtype=np.uint8)
+        self.shard.dup = np.zeros(size, dtype=np.uint8)
+        self.logfile = tempfile.NamedTemporaryFile()
+        self.shard.logfile = os.open(self.logfile.name, os.O_WRONLY | os.O_APPEND)
+
+    def tearDown(self):
+        os.close(self.shard.logfile)
+        self.logfile.close()
+
+    def consume(self, numbers):
+        frames = b''.join(b'%09d\n' % number for number in numbers)
+        self.shard.consume_numbers(np.array(numbers, dtype=np.uint64).tobytes() + frames)
+
+    def log_lines(self):
+        self.shard.flush_log()
+        with open(self.logfile.name) as logfile:
+            return logfile.read().splitlines()
+
+    def assertReport(self, unique, duplicates, total):
+        offset = 3 * self.INDEX
+        self.assertEqual(self.shard.current_report, [unique, duplicates, total])
+        self.assertEqual(self.counters[offset:offset + 3], [unique, duplicates, total])
+        self.assertEqual(self.counters[:offset] + self.counters[offset + 3:], [0] * (3 * self.SHARDS - 3))
+
+    def test_GivenSeveralMessages_WhenConsumingTheNumbers_ThenTheCountersAndTheLogAreUpdated(self):
+        # Repeated numbers within a single message
+        self.consume([5, 9, 5, 13, 5])
+        self.assertReport(3, 2, 2)
+        self.assertEqual(self.log_lines(), ['000000005', '000000009', '000000013'])
+
+        # Numbers seen in a previous message and new numbers repeated in the message
+        self.consume([9, 17, 13, 17])
+        self.assertReport(4, 5, 0)
+        self.assertEqual(self.log_lines()[3:], ['000000017'])
+
+        # Numbers already marked as duplicated
+        self.consume([5, 9, 21, 17])
+        self.assertReport(5, 8, 1)
+        self.assertEqual(self.log_lines()[4:], ['000000021'])
+
+        # Only numbers already seen
+        self.consume([21, 21])
+        self.assertReport(5, 10, 0)
+        self.assertEqual(len(self.log_lines()), 5)
+
+    def test_GivenRandomMessages_WhenConsumingTheNumbers_ThenTheResultMatchesASetBasedCount(self):
+        seen = set()
+        counts = {}
+        log = []
+        duplicates = 0
+        for message in range(20):
+            numbers = [random.randrange(self.INDEX, 400, self.SHARDS) for i in range(random.randint(1, 50))]
+            self.consume(numbers)
+            for number in numbers:
+                counts[number] = counts.get(number, 0) + 1
+                if number in seen:
+                    duplicates += 1
+                else:
+                    seen.add(number)
+                    log.append('%09d' % number)
+
+            total = sum(1 for count in counts.values() if count == 1)
+            self.assertReport(len(seen), duplicates, total)
+            self.assertEqual(self.log_lines(), log)
+
 
 if __name__ == '__main__':
     unittest.main()